@@ -1,24 +1,81 @@
 import argparse
-import ipdb
+import contextlib
 import os
 import configparser
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import Any
 import re
+import sys
 from lxml import etree
 
 
+# fill/stroke CSS rules, e.g. .fill-red {fill:#ff0000;}
+_CSS_RULE_RE = re.compile(
+    r"\.(?P<rule_type>fill|stroke)-(?P<color_name>[a-zA-Z0-9]+)\s*\{\1:#(?P<color>[a-fA-F0-9]{3}(?:[a-fA-F0-9]{3})?);\}"
+)
+_MARKER_KINDS = ("start", "end", "mid")
+
+# Let libxml2 filter the elements that need work instead of walking the whole tree in Python
+_CANDIDATES = etree.XPath("//*[@style or @fill or @stroke]")
+_MARKER_CANDIDATES = etree.XPath("//*[@style]")
+_ID_CANDIDATES = etree.XPath("//*[@id]")
+
+# Large Inkscape/plotter exports can exceed libxml2's default safety limits
+_PARSER = etree.XMLParser(huge_tree=True)
+
+
 class Attribute:
+    __slots__ = ("is_set", "value")
+
     def __init__(self):
+        self.reset()
+
+    def reset(self):
         self.is_set: bool = False
         self.value: str | Any | None = None
 
 
+def _set_fill(value, fill_attr, stroke_attr, color_mapping) -> bool:
+    if value not in color_mapping:
+        return False
+    fill_attr.is_set = True
+    if value != "none":
+        fill_attr.value = value
+    return True
+
+
+def _set_stroke(value, fill_attr, stroke_attr, color_mapping) -> bool:
+    if value not in color_mapping:
+        return False
+    stroke_attr.is_set = True
+    if value != "none":
+        stroke_attr.value = value
+    return True
+
+
+# Style declarations that get turned into classes, keyed by property name
+_STYLE_HANDLERS = {"fill": _set_fill, "stroke": _set_stroke}
+
+
+def _positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Modify fill and stroke colors in the <style> section of an SVG file."
     )
-    parser.add_argument(
-        "-i", "--input_file", type=str, required=True, help="Path to the SVG file"
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "-i", "--input_file", type=str, help="Path to the SVG file"
+    )
+    inputs.add_argument(
+        "--input-dir", type=str, help="Directory of SVG files to process"
     )
     parser.add_argument(
         "-o",
@@ -26,32 +83,46 @@ def parse_args():
         type=str,
         required=False,
         default="",
-        help="Output path to the SVG file. If not provided, will modify the input file inplace.",
+        help="Output path to the SVG file, or output directory with --input-dir. If not provided, will modify the input files inplace.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        default=None,
+        help="Number of worker processes, only valid with --input-dir. Defaults to the number of CPUs.",
     )
     parser.add_argument("--theme", type=str, help="Theme to use")
     parser.add_argument("--force-fill", default=False, action='store_true')
-    return parser.parse_args()
+    parser.add_argument(
+        "--debug",
+        default=False,
+        action='store_true',
+        help="Drop into ipdb when an exception is raised",
+    )
+    args = parser.parse_args()
+    if args.input_dir is not None:
+        if not os.path.isdir(args.input_dir):
+            parser.error(f"--input-dir {args.input_dir} is not a directory")
+        if os.path.isfile(args.output_file):
+            parser.error(f"--output_file {args.output_file} must be a directory when using --input-dir")
+    elif args.jobs is not None:
+        parser.error("--jobs can only be used with --input-dir")
+    # Fail once here rather than once per file
+    try:
+        load_theme_colors(args.theme)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 
 def load_file(svg_path):
-    return etree.parse(svg_path)
-
-def get_namespace_details(element):
-    # Extracting namespace and prefix from the root element
-    namespace_match = re.match(r'\{.*\}', element.tag)
-    namespace_uri = namespace_match.group(0) if namespace_match else ''
-    prefix = ''
-    for ns_prefix, ns_uri in element.nsmap.items():
-        if ns_uri == namespace_uri.strip('{}'):
-            prefix = ns_prefix
-            break
-    return namespace_uri, prefix
+    return etree.parse(svg_path, _PARSER)
 
 def get_style_element(tree):
     root = tree.getroot()
-    namespace_uri, _ = get_namespace_details(root)
+    namespace_uri = etree.QName(root).namespace
     # Define the style tag with namespace prefix if it exists
-    style_tag = f"{namespace_uri}style" if namespace_uri != "" else "style"
+    style_tag = f"{{{namespace_uri}}}style" if namespace_uri else "style"
 
     # Find or create the <style> element
     style_element = root.find(style_tag)
@@ -74,36 +145,31 @@ def update_svg_style(tree, new_colors):
     """
     style_element = get_style_element(tree)
 
-    style_content: str = str(style_element.text)
-
-    # Regular expression to match the fill and stroke classes
-    css_pattern = r".(?P<rule_type>(fill|stroke))-(?P<color_name>[a-zA-Z0-9]+) {(\1):#(?P<color>[a-fA-F0-9]{3}([a-fA-F0-9]{3})?);}"
-
-    # Find all CSS rules
-    css_rules = re.finditer(css_pattern, style_content)
-
-    # Update existing CSS rules and keep track of which colors are updated
-    updated_colors = set()
-    for color_match in css_rules:
-        color_match = color_match.groupdict()
-        color_name = color_match['color_name']
-        rule_type = color_match['rule_type']
-        if color_name in new_colors:
-            new_color = new_colors[color_name]
-            style_content = re.sub(
-                f".{rule_type}-{color_name} {{\1:#([a-fA-F0-9]{3}([a-fA-F0-9]{3})?);}}",
-                f".{rule_type}-{color_name} {{{rule_type}:{new_color};}}",
-                style_content,
-            )
-            updated_colors.add(color_name)
+    style_content: str = style_element.text or ""
+
+    # Update existing CSS rules in a single pass and keep track of which (rule_type, color_name) are updated
+    updated_rules = set()
+
+    def _replace(match):
+        color_name = match['color_name']
+        rule_type = match['rule_type']
+        if color_name not in new_colors:
+            return match.group(0)
+        updated_rules.add((rule_type, color_name))
+        return f".{rule_type}-{color_name} {{{rule_type}:{new_colors[color_name]};}}"
+
+    # A freshly created <style> element has nothing to update
+    if style_content:
+        style_content = _CSS_RULE_RE.sub(_replace, style_content)
 
     # Add new CSS rules for colors not already in the style section
+    new_rules = []
     for color_name, color_value in new_colors.items():
-        if color_name not in updated_colors:
-            style_content += f"\n        .fill-{color_name} {{fill:{color_value};}}"
-            style_content += f"\n        .stroke-{color_name} {{stroke:{color_value};}}"
+        for rule_type in ("fill", "stroke"):
+            if (rule_type, color_name) not in updated_rules:
+                new_rules.append(f"\n        .{rule_type}-{color_name} {{{rule_type}:{color_value};}}")
 
-    style_element.text = style_content
+    style_element.text = style_content + "".join(new_rules)
 
     return tree
 
@@ -125,98 +191,116 @@ def replace_color(tree, color_mapping):
         if style_attr == "":
             return ""
         for style in style_attr.split(";"):
-            if style == "":
+            if not style.strip():
                 continue
-
-            attr, value = style.split(":")
+            # partition only splits on the first ':' so values such as url(data:...) stay intact
+            attr, sep, value = style.partition(":")
             attr = attr.strip()
-            value = value.strip()
-            if attr == "fill" and value in color_mapping:
-                fill_attr.is_set = True
-                if value != "none":
-                    fill_attr.value = value
-
-
-            elif attr == "stroke" and value in color_mapping:
-                stroke_attr.is_set = True
-                if value != "none":
-                    stroke_attr.value = value
-
-            else:
+            if not attr or not sep:
+                updated_style.append(style)
+                continue
+            handler = _STYLE_HANDLERS.get(attr)
+            if handler is None or not handler(value.strip(), fill_attr, stroke_attr, color_mapping):
                 updated_style.append(style)
         return ";".join(updated_style)
 
-    # Iterate through all elements and replace fill and stroke attributes
-    for element in root.iter():
-        fill_attr = Attribute()
-        stroke_attr = Attribute()
-        if "style" in element.attrib:
-            new_style = modify_style_attribute(element.attrib["style"], fill_attr, stroke_attr)
-            element.set("style", new_style)
-
-        if "fill" in element.attrib and not fill_attr.is_set:
+    # Iterate through candidate elements and replace fill and stroke attributes
+    fill_attr = Attribute()
+    stroke_attr = Attribute()
+    for element in _CANDIDATES(root):
+        attrib = element.attrib
+        style = attrib.get("style")
+        has_fill = "fill" in attrib
+        has_stroke = "stroke" in attrib
+        if not (style or has_fill or has_stroke):
+            continue
+
+        fill_attr.reset()
+        stroke_attr.reset()
+        if style is not None:
+            new_style = modify_style_attribute(style, fill_attr, stroke_attr)
+            attrib["style"] = new_style
+
+        if has_fill and not fill_attr.is_set:
             fill_attr.is_set = True
-            fill_attr.value = element.attrib["fill"]
+            fill_attr.value = attrib["fill"]
 
-        if "stroke" in element.attrib and not stroke_attr.is_set:
+        if has_stroke and not stroke_attr.is_set:
             stroke_attr.is_set = True
-            stroke_attr.value = element.attrib["stroke"]
+            stroke_attr.value = attrib["stroke"]
         
-        if (classes := element.get("class")) is None:
+        if (classes := attrib.get("class")) is None:
             classes = set()
         else:
-            classes = set([c.strip() for c in classes.split(" ")])
+            classes = set(classes.split())
         if fill_attr.is_set  and fill_attr.value in color_mapping:
             classes = [c for c in classes if not c.startswith('fill')]
             classes.append(f"fill-{color_mapping[fill_attr.value]}")
-            if 'fill' in element.attrib:
-                del element.attrib["fill"]
+            if has_fill:
+                del attrib["fill"]
         if stroke_attr.is_set and stroke_attr.value in color_mapping:
             classes = [c for c in classes if not c.startswith('stroke')]
             classes.append(f"stroke-{color_mapping[stroke_attr.value]}")
-            if 'stroke' in element.attrib:
-                del element.attrib["stroke"]
+            if has_stroke:
+                del attrib["stroke"]
         if len(classes) > 0:
-            element.set("class", " ".join(classes).strip())
-
-def find_element_with_id(tree, element_id):
-    root = tree.getroot()
-    return root.find(f".//*[@id='{element_id}']")
+            attrib["class"] = " ".join(classes)
 
 def deal_with_markers(tree, force_fill=False):
     # marker-start:url(#marker49)
     root = tree.getroot()
-    pattern = r"marker-(start|end|mid):url\(#(?P<marker_id>.*)\)"
-    regex = re.compile(pattern)
-
-    for element in root.iter():
-        if "style" in element.attrib:
-            for style in element.attrib['style'].split(';'):
-                if (result := regex.match(style.strip())) is not None and (classes := element.get("class")) is not None:
+    # Built on the first marker reference, most SVGs have none
+    id_index = None
+
+    for element in _MARKER_CANDIDATES(root):
+        if "marker-" in (style_attr := element.attrib['style']):
+            for style in style_attr.split(';'):
+                style = style.strip()
+                if not style.startswith("marker-"):
+                    continue
+                # The declaration has a fixed shape, so plain string slicing is enough
+                kind, _, value = style[len("marker-"):].partition(":")
+                if kind not in _MARKER_KINDS or not value.startswith("url(#"):
+                    continue
+                marker_id, closed, _ = value[len("url(#"):].partition(")")
+                if not closed or not marker_id:
+                    continue
+                if (classes := element.get("class")) is not None:
                     classes = [c for c in classes.split(" ") if c.startswith('fill') or c.startswith('stroke')]
-                    marker_id = result.groupdict()['marker_id']
-                    marker_element = find_element_with_id(tree, marker_id)
+                    if id_index is None:
+                        # First element wins on duplicate ids, like root.find would
+                        id_index = {el.get("id"): el for el in reversed(_ID_CANDIDATES(root))}
+                    if (marker_element := id_index.get(marker_id)) is None:
+                        continue
                     if (marker_classes := marker_element.get("class")) is None:
                         marker_classes = set()
                     else:
-                        marker_classes = set([c.strip() for c in marker_classes.split(" ")])
+                        marker_classes = set(marker_classes.split())
 
                     marker_classes.update(classes)
                     if force_fill and len(classes) > 0:
                         color = list(classes)[0].split('-')[1]
                         marker_classes.add(f'fill-{color}')
                     if len(marker_classes) > 0:
-                        marker_element.set("class", " ".join(marker_classes).strip())
+                        marker_element.set("class", " ".join(marker_classes))
 
 
 
+@functools.lru_cache(maxsize=None)
 def get_file_path(filename):
     current_file_path = os.path.abspath(__file__)
     current_directory = os.path.dirname(current_file_path)
     return os.path.join(current_directory, filename)
 
 
+@functools.lru_cache(maxsize=None)
 def load_theme_colors(theme = None) -> dict:
+    """
+    Loads the colors of a theme from themes.ini, or of every theme if theme is None.
+
+    The result is cached and shared between callers, do not mutate it.
+    Call with theme as a positional argument so all callers hit the same cache entry.
+    """
     themes_file = get_file_path('themes.ini')
     config = configparser.ConfigParser()
     config.read(themes_file)
@@ -233,7 +317,13 @@ def load_theme_colors(theme = None) -> dict:
         color_mapping[theme] = {key: f"#{value}" for key, value in config[theme].items()}
     return color_mapping
 
+@functools.lru_cache(maxsize=None)
 def load_color_mapping() -> dict:
+    """
+    Loads the mapping from hex colors to color names.
+
+    The result is cached and shared between callers, do not mutate it.
+    """
     themes_file = get_file_path('color_mapping.ini')
     config = configparser.ConfigParser()
     config.read(themes_file)
@@ -241,28 +331,94 @@ def load_color_mapping() -> dict:
     color_mapping = {f"#{key}": value for key, value in config['color.mapping'].items()}
 
     # Get mapping from theme file 
-    theme_colors = load_theme_colors(theme=None)
-    for theme in theme_colors:
-        color_mapping.update({value:key  for key, value in theme_colors[theme].items()})
+    theme_colors = load_theme_colors(None)
+    color_mapping.update(
+        {value: key for colors in theme_colors.values() for key, value in colors.items()}
+    )
     return color_mapping
 
 
+def modify_tree(input_file, theme, force_fill):
+    # Replace colors with classes in the SVG file
+    tree = load_file(input_file)
+    theme_colors = load_theme_colors(theme)
+    color_mapping = load_color_mapping()
+    tree = update_svg_style(tree, theme_colors)
+    replace_color(tree, color_mapping)
+    deal_with_markers(tree, force_fill)
+    return tree
+
+
+def write_file(tree, output_file):
+    tree.write(
+        output_file,
+        encoding="utf-8",
+        xml_declaration=True,
+        method="xml",
+    )
+
+
+def process_one(input_file, output_file, theme, force_fill):
+    write_file(modify_tree(input_file, theme, force_fill), output_file)
+
+
+def _process_one_in_worker(input_file, output_file, theme, force_fill):
+    # lxml errors carry an unpicklable error log, so report failures as plain strings
+    try:
+        process_one(input_file, output_file, theme, force_fill)
+    except Exception as e:
+        return f"{input_file}: {type(e).__name__}: {e}"
+    return None
+
+
 if __name__ == "__main__":
-    with ipdb.launch_ipdb_on_exception():
-        args = parse_args()
-
-        # Replace colors with classes in the SVG file
-        tree = load_file(args.input_file)
-        theme_colors = load_theme_colors(args.theme)
-        color_mapping = load_color_mapping()
-        tree = update_svg_style(tree, theme_colors)
-        replace_color(tree, color_mapping)
-        deal_with_markers(tree, args.force_fill)
-
-        # Modify the SVG file
-        try:
-            tree.write(
-                args.output_file if args.output_file != "" else args.input_file,
+    args = parse_args()
+    if args.debug:
+        # Imported lazily, pulling in IPython is slow
+        import ipdb
+        debug_context = ipdb.launch_ipdb_on_exception()
+    else:
+        debug_context = contextlib.nullcontext()
+
+    with debug_context:
+        if args.input_dir is None:
+            tree = modify_tree(args.input_file, args.theme, args.force_fill)
+
+            # Modify the SVG file
+            try:
+                write_file(
+                    tree,
+                    args.output_file if args.output_file != "" else args.input_file,
+                )
+            except Exception as e:
+                print(f"Error: {e}")
+        else:
+            if args.output_file != "":
+                output_dir = args.output_file
+                os.makedirs(output_dir, exist_ok=True)
+            else:
+                output_dir = args.input_dir
+            # Match the extension case-insensitively so .SVG files are picked up too
+            input_files = sorted(
+                os.path.join(args.input_dir, name)
+                for name in os.listdir(args.input_dir)
+                if name.lower().endswith(".svg")
+                and os.path.isfile(os.path.join(args.input_dir, name))
             )
-        except Exception as e:
-            print(f"Error: {e}")
+            output_files = [os.path.join(output_dir, os.path.basename(f)) for f in input_files]
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                errors = [
+                    error
+                    for error in executor.map(
+                        _process_one_in_worker,
+                        input_files,
+                        output_files,
+                        repeat(args.theme),
+                        repeat(args.force_fill),
+                    )
+                    if error is not None
+                ]
+            for error in errors:
+                print(f"Error: {error}", file=sys.stderr)
+            if errors:
+                sys.exit(1)